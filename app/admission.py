@@ -0,0 +1,82 @@
+import os
+import time
+import logging
+import itertools
+
+# Admission control for the audio queue.
+# Wait time is estimated from the audio duration of every queued job and the
+# recently observed processing speed (seconds of work per second of audio).
+
+MAX_QUEUE_WAIT = int(os.getenv('MAX_QUEUE_WAIT', 1800))  # Reject new jobs above this wait (seconds)
+SECONDS_PER_AUDIO_SECOND = float(os.getenv('SECONDS_PER_AUDIO_SECOND', 0.5))  # Initial speed guess
+DEFAULT_DURATION = 240  # Used when the song duration is unknown (seconds)
+SMOOTHING = 0.3  # Weight of the newest job in the moving average
+MAX_REMEMBERED_DURATIONS = 1000
+
+seconds_per_audio_second = SECONDS_PER_AUDIO_SECOND
+durations = {}  # file_id -> duration of the song in seconds
+running_jobs = {}  # job token -> (started_at, estimated_seconds) of jobs being processed
+job_tokens = itertools.count()
+
+def remember_duration(file_id: str, duration: int):
+    """Store the duration of an uploaded song so queued jobs can be estimated later."""
+    if not duration:
+        return
+    durations.pop(file_id, None)
+    durations[file_id] = duration
+    if len(durations) > MAX_REMEMBERED_DURATIONS:
+        # Drop the oldest entry, dicts keep insertion order
+        durations.pop(next(iter(durations)))
+
+def get_duration(file_id: str) -> int:
+    return durations.get(file_id, DEFAULT_DURATION)
+
+def estimate_job(file_id: str) -> float:
+    """Estimated processing time of one job in seconds."""
+    return get_duration(file_id) * seconds_per_audio_second
+
+def estimate_wait(queued_file_ids, workers: int = 1) -> float:
+    """Estimated time in seconds before a job added now would start processing."""
+    wait = sum(estimate_job(file_id) for file_id in queued_file_ids)
+    now = time.time()
+    for started_at, estimated in running_jobs.values():
+        wait += max(estimated - (now - started_at), 0)
+    return wait / workers
+
+def can_admit(wait: float) -> bool:
+    return wait <= MAX_QUEUE_WAIT
+
+def start_job(file_id: str) -> int:
+    token = next(job_tokens)
+    running_jobs[token] = (time.time(), estimate_job(file_id))
+    return token
+
+def finish_job(token: int, file_id: str, elapsed: float = None):
+    """Clear the running job and, for successful jobs, update the processing speed."""
+    global seconds_per_audio_second
+    running_jobs.pop(token, None)
+    duration = durations.get(file_id)
+    if elapsed is None or not duration:
+        return
+    observed = elapsed / duration
+    seconds_per_audio_second = (1 - SMOOTHING) * seconds_per_audio_second + SMOOTHING * observed
+    logging.info(f"Processing speed: {seconds_per_audio_second:.2f} s per second of audio.")
+
+def format_eta(seconds: float) -> str:
+    minutes = round(seconds / 60)
+    if minutes < 1:
+        return "less than a minute"
+    return f"~{minutes} min"
+
+def wait_text(position: int, eta: float) -> str:
+    return (
+        "Please wait ...\n\n"
+        f"Your position in queue: {position}\n"
+        f"Estimated time: {format_eta(eta)}"
+    )
+
+def busy_text(wait: float) -> str:
+    return (
+        f"The bot is busy right now, the estimated wait is {format_eta(wait)}.\n"
+        "Please try again later."
+    )
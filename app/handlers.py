@@ -10,13 +10,28 @@ from aiogram.filters import CommandStart, Command
 from aiogram.types import Message, FSInputFile, CallbackQuery
 from aiogram.exceptions import TelegramAPIError
 import data.connection as dataPostgres
+import app.admission as admission
+import governor
+import memory_watchdog
+import app.profiles as profiles
+import app.precompute as precompute
+import app.keyboardInline as kbIn
+import time
+import itertools
 import shutil  # For deleting directories and their content
 from collections import deque
 
 router = Router()
 audio_queue = deque()
-processing_semaphore = asyncio.Semaphore(1)  # Limit to 1 concurrent tasks
+MAX_CONCURRENT_JOBS = governor.MAX_CONCURRENT_JOBS
+processing_semaphore = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
 processing = False
+running_tasks = set()
+job_ids = itertools.count()
+in_flight = {}  # (file_id, percentage, profile) -> [(chat_id, wait message)] waiting for the same output
+QUEUE_REFRESH_INTERVAL = float(os.getenv('QUEUE_REFRESH_INTERVAL', 5))  # Min seconds between queue message updates
+shown_wait_texts = {}  # (chat_id, message_id) -> text last shown in a wait message
+queue_refresh_task = None
 QUEUE_FILE = 'audio_queue.json'
 
 # Load the audio queue from a JSON file.
@@ -69,7 +84,7 @@ async def forward_message_to_user(bot: Bot, from_chat_id: int, message_id: int,
 async def cmd_start(message: Message):
     user_id = message.from_user.id
     userName = message.from_user.username
-    await dataPostgres.insert_user_if_not_exists(user_id, userName)
+    dataPostgres.queue_user_upsert(user_id, userName)
     photo = FSInputFile("./images/photo_2024-09-13_10-23-12.jpg")
     await message.answer_photo(photo, caption=(
         "Welcome to MinusGolos bot\n\n"
@@ -83,22 +98,109 @@ async def handle_playlist_move(callback: CallbackQuery, bot: Bot):
     vocal_percentage = int(vocal_percentage)
     file_id = await dataPostgres.get_file_id_by_id(int(id_input))
     chat_id = callback.from_user.id
+    precompute.record_request(file_id)
     processing_message = await callback.message.edit_text("Please wait ...")
 
-    if await dataPostgres.check_file_exists_with_percentage(file_id, vocal_percentage):
-        id = await dataPostgres.get_output_id_for_percentage(file_id, vocal_percentage)
-        from_chat_id, message_id = await dataPostgres.get_chat_and_message_id_by_id(id, vocal_percentage)
+    wait = estimate_queue_wait()
+    preferred = await profiles.get_user_profile(chat_id)
+    profile = profiles.choose_profile(preferred, wait)
+    # Without an explicit preference the full quality output is fine too
+    cached_profiles = [profile]
+    if preferred is None and profile != profiles.DEFAULT_PROFILE:
+        cached_profiles.append(profiles.DEFAULT_PROFILE)
+    from_chat_id, message_id = await find_cached_output(file_id, vocal_percentage, cached_profiles)
+    if message_id:
         await forward_message_to_user(bot, from_chat_id, message_id, chat_id)
+        await bot.delete_message(chat_id, processing_message.message_id)
+        return
+
+    # The same output is already queued or being made, send it to this user too
+    key = (file_id, vocal_percentage, profile)
+    if key in in_flight:
+        in_flight[key].append((chat_id, callback.message))
+        await edit_wait_message(callback.message, "Please wait ...\n\nThis song is already being processed.")
+        return
+
+    if not admission.can_admit(wait):
+        logging.info(f"Rejected job for user {chat_id}, estimated wait {wait:.0f} s.")
+        await callback.message.edit_text(admission.busy_text(wait))
+        return
+
+    # Every job gets its own folder, parallel jobs for the same song must not share files
+    save_directory = f'./inputSongs{vocal_percentage}:{id_input}:{profile}:{next(job_ids)}'
+    os.makedirs(save_directory, exist_ok=True)
+
+    file_name = await dataPostgres.get_name_by_id(file_id)
+    file_path = os.path.join(save_directory, format_column_namesForDatabase(file_name))
+    in_flight[key] = []
+    audio_queue.append((bot, callback.message, file_id, file_name, file_path, chat_id, vocal_percentage, save_directory, profile))
+    precompute.yield_to_interactive()
+    await edit_wait_message(callback.message, admission.wait_text(len(audio_queue), wait + admission.estimate_job(file_id)))
+    # The wait message is deleted by the queue once the job is finished
+    await process_audio_queue()
+
+async def find_cached_output(file_id: str, percent: int, cached_profiles):
+    """Return (chat_id, message_id) of an already sent output in one of the profiles."""
+    for profile in cached_profiles:
+        if profile == profiles.DEFAULT_PROFILE:
+            if await dataPostgres.check_file_exists_with_percentage(file_id, percent):
+                id = await dataPostgres.get_output_id_for_percentage(file_id, percent)
+                return await dataPostgres.get_chat_and_message_id_by_id(id, percent)
+        else:
+            from_chat_id, message_id = await dataPostgres.get_profile_output(file_id, percent, profile)
+            if message_id:
+                return from_chat_id, message_id
+    return None, None
+
+async def store_output(sendFile: Message, file_id: str, percent: int, profile: str):
+    if profile == profiles.DEFAULT_PROFILE:
+        id = await track_message(sendFile, percent)
+        await dataPostgres.update_out_id_by_percent(file_id, id, percent)
     else:
-        save_directory = f'./inputSongs{vocal_percentage}:{id_input}'
-        os.makedirs(save_directory, exist_ok=True)
+        await dataPostgres.insert_profile_output(file_id, percent, profile, sendFile.chat.id, sendFile.message_id)
 
-        file_name = await dataPostgres.get_name_by_id(file_id)
-        file_path = os.path.join(save_directory, format_column_namesForDatabase(file_name))
-        audio_queue.append((bot, callback.message, file_id, file_name, file_path, chat_id, vocal_percentage, id_input))
-        await process_audio_queue()
+def is_idle():
+    return not audio_queue and not running_tasks
+
+def queued_file_ids():
+    return [task[2] for task in audio_queue]
+
+def estimate_queue_wait():
+    return admission.estimate_wait(queued_file_ids(), MAX_CONCURRENT_JOBS)
+
+async def edit_wait_message(message: Message, text: str):
+    # Only edit when the text changed, every edit is a Bot API call
+    key = (message.chat.id, message.message_id)
+    if shown_wait_texts.get(key) == text:
+        return
+    shown_wait_texts[key] = text
+    try:
+        await message.edit_text(text)
+    except TelegramAPIError as e:
+        logging.debug(f"Could not update wait message {message.message_id}: {e}")
+
+def forget_wait_message(message: Message):
+    shown_wait_texts.pop((message.chat.id, message.message_id), None)
+
+async def update_queue_messages():
+    """Refresh position and ETA of every job still waiting in the queue."""
+    wait = admission.estimate_wait([], MAX_CONCURRENT_JOBS)
+    for position, task in enumerate(list(audio_queue), start=1):
+        message, file_id = task[1], task[2]
+        wait += admission.estimate_job(file_id) / MAX_CONCURRENT_JOBS
+        await edit_wait_message(message, admission.wait_text(position, wait))
+
+async def refresh_queue_messages():
+    """Update the queue messages at most every QUEUE_REFRESH_INTERVAL seconds while jobs are waiting."""
+    while audio_queue:
+        await asyncio.sleep(QUEUE_REFRESH_INTERVAL)
+        await update_queue_messages()
 
-    await bot.delete_message(chat_id, processing_message.message_id)
+def schedule_queue_refresh():
+    # Runs beside the dispatch loop, so starting jobs never waits on message edits
+    global queue_refresh_task
+    if queue_refresh_task is None or queue_refresh_task.done():
+        queue_refresh_task = asyncio.create_task(refresh_queue_messages())
 
 async def process_audio_queue():
     global processing
@@ -108,42 +210,88 @@ async def process_audio_queue():
     processing = True
 
     while audio_queue:
-        task = audio_queue.popleft()
-        bot, message, file_id, file_name, file_path, user_id, vocal_percentage, id_input = task
-
-        async with processing_semaphore:
-            try:
-                file = await bot.get_file(file_id)
-                await asyncio.wait_for(bot.download_file(file.file_path, destination=file_path), timeout=600)
-                logging.info(f"File {file_name} downloaded successfully to {file_path}")
-                logging.info(f"Processing audio file with vocal percentage: {vocal_percentage}%")
-
-                processed_audio_file, output_folder = await process_audio_file(file_path, vocal_percentage, id_input)
-                if processed_audio_file is None:
-                    raise ValueError("Processed audio file is None. Ensure the processing function returns a valid file path.")
-
-                sendFile = await asyncio.wait_for(bot.send_audio(chat_id=user_id, audio=FSInputFile(processed_audio_file)), timeout=240)
-                id = await track_message(sendFile, vocal_percentage)
-                await dataPostgres.update_out_id_by_percent(file_id, id, vocal_percentage)
-
-                try:
-                    if os.path.exists(output_folder):
-                        shutil.rmtree(output_folder)
-                        logging.info(f"Deleted output folder: {output_folder}")
-                    logging.info("Garbage collection executed.")
-                except Exception as cleanup_error:
-                    logging.error(f"Error cleaning up files: {cleanup_error}")
-
-            except asyncio.TimeoutError:
-                logging.error("Processing the file took too long.")
-                await message.reply("Processing the file took too long. Please try again later.")
-            except Exception as process_error:
-                logging.error(f"Error processing audio file: {process_error}", exc_info=True)
-                fail_add_message = f"Failed to process {file_name} due to an error: {str(process_error)}"
-                await message.reply(fail_add_message)
+        # Start up to MAX_CONCURRENT_JOBS jobs, the separator batches them together
+        await processing_semaphore.acquire()
+        # Hold the next job back while its predicted memory does not fit the budget
+        duration = admission.get_duration(audio_queue[0][2])
+        while running_tasks and not memory_watchdog.can_start(duration):
+            await asyncio.wait(set(running_tasks), return_when=asyncio.FIRST_COMPLETED)
+        reservation = memory_watchdog.reserve(duration)
+        task = asyncio.create_task(process_audio_task(audio_queue.popleft(), reservation))
+        running_tasks.add(task)
+        task.add_done_callback(running_tasks.discard)
+        schedule_queue_refresh()
 
     processing = False
 
+async def process_audio_task(task, reservation):
+    bot, message, file_id, file_name, file_path, user_id, vocal_percentage, save_directory, profile = task
+
+    token = admission.start_job(file_id)
+    usage = governor.start_job()
+    started_at = time.time()
+    elapsed = None
+    sendFile = None
+    fail_message = None
+    await edit_wait_message(message, f"Processing your song ...\n\nEstimated time: {admission.format_eta(admission.estimate_job(file_id))}")
+    try:
+        file = await bot.get_file(file_id)
+        await asyncio.wait_for(bot.download_file(file.file_path, destination=file_path), timeout=600)
+        logging.info(f"File {file_name} downloaded successfully to {file_path}")
+        logging.info(f"Processing audio file with vocal percentage: {vocal_percentage}%")
+
+        processed_audio_file, _ = await process_audio_file(file_path, vocal_percentage, save_directory, profile)
+        if processed_audio_file is None:
+            raise ValueError("Processed audio file is None. Ensure the processing function returns a valid file path.")
+
+        upload_size = os.path.getsize(processed_audio_file)
+        upload_started_at = time.time()
+        sendFile = await asyncio.wait_for(bot.send_audio(chat_id=user_id, audio=FSInputFile(processed_audio_file)), timeout=240)
+        profiles.record_upload(profile, upload_size, time.time() - upload_started_at)
+        await store_output(sendFile, file_id, vocal_percentage, profile)
+        elapsed = time.time() - started_at
+
+    except asyncio.TimeoutError:
+        logging.error("Processing the file took too long.")
+        fail_message = "Processing the file took too long. Please try again later."
+        await message.reply(fail_message)
+    except Exception as process_error:
+        logging.error(f"Error processing audio file: {process_error}", exc_info=True)
+        fail_message = f"Failed to process {file_name} due to an error: {str(process_error)}"
+        await message.reply(fail_message)
+    finally:
+        try:
+            if os.path.exists(save_directory):
+                shutil.rmtree(save_directory)
+                logging.info(f"Deleted output folder: {save_directory}")
+        except Exception as cleanup_error:
+            logging.error(f"Error cleaning up files: {cleanup_error}")
+        # Taken before any await, so later requests for this output hit the cache or start a new job
+        followers = in_flight.pop((file_id, vocal_percentage, profile), [])
+        admission.finish_job(token, file_id, elapsed)
+        governor.finish_job(usage)
+        memory_watchdog.release(reservation)
+        processing_semaphore.release()
+        forget_wait_message(message)
+        try:
+            await bot.delete_message(user_id, message.message_id)
+        except TelegramAPIError as e:
+            logging.error(f"Error deleting wait message: {e}")
+        await notify_followers(bot, followers, sendFile, fail_message)
+
+async def notify_followers(bot: Bot, followers, sendFile: Message, fail_message: str):
+    """Send the result of a job to the users who asked for the same output while it ran."""
+    for chat_id, wait_message in followers:
+        forget_wait_message(wait_message)
+        try:
+            if sendFile:
+                await forward_message_to_user(bot, sendFile.chat.id, sendFile.message_id, chat_id)
+            else:
+                await wait_message.reply(fail_message or "Processing the file failed. Please try again later.")
+            await bot.delete_message(chat_id, wait_message.message_id)
+        except TelegramAPIError as e:
+            logging.error(f"Error notifying user {chat_id}: {e}")
+
 @router.message(Command("help"))
 async def cmd_help(message: Message):
     photo = FSInputFile("./images/help.jpg")
@@ -154,14 +302,42 @@ async def cmd_help(message: Message):
             f"0% button - it is button for getting the 0% vocal audio file\n"
             f"15% button - it is button for getting the audio with 15% vocal volume for better quality\n"
             f"50% button - it is button for getting the audio with 50% vocal volume for better melody\n"
+            "/quality - choose the audio quality, smaller files are sent faster\n"
             "If u get error that process is too long please try again\n\n"
             "Do not forget. Day by day the bot will become more and more faster\n"
             "U can check it by practicing ...\n\n"
             "If u have technical problems. U can contact admin"))
 
+@router.message(Command("quality"))
+async def cmd_quality(message: Message):
+    current = await profiles.get_user_profile(message.from_user.id) or profiles.DEFAULT_PROFILE
+    await message.answer(
+        f"Current quality: {profiles.PROFILES[current]['label']}\n\n"
+        "Smaller files are sent faster.",
+        reply_markup=await kbIn.profile_choose())
+
+@router.callback_query(F.data.startswith("profile:"))
+async def handle_profile_choose(callback: CallbackQuery):
+    _, profile = callback.data.split(":")
+    try:
+        await profiles.set_user_profile(callback.from_user.id, callback.from_user.username, profile)
+    except ValueError as e:
+        logging.error(f"Error choosing output profile: {e}")
+        await callback.answer("Unknown quality.")
+        return
+    # Stops the button's loading spinner
+    await callback.answer()
+    await callback.message.edit_text(f"Quality set to {profiles.PROFILES[profile]['label']}.")
+
 ADMIN_ID = 1031267509
 forwarding_enabled = False
 
+@router.message(Command("profiles"))
+async def cmd_profiles(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    await message.answer(profiles.upload_report())
+
 @router.message()
 async def handle_message_reklama(message: Message):
     global forwarding_enabled
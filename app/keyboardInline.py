@@ -1,17 +1,16 @@
 from aiogram.types import InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder  # Import builder to help adjust rows of buttons
-import data.connection as dataPostgres
+from app.profiles import PROFILES
 
-async def percent_choose(file_id: str):
+async def percent_choose(id: int):
     """
-    Creates an InlineKeyboardMarkup with buttons for 0% and 15% vocal mix options.
+    Creates an InlineKeyboardMarkup with buttons for 0%, 15% and 50% vocal mix options.
 
-    :param file_id: The ID of the file being processed, used in callback data.
+    :param id: The input_file id of the file being processed, used in callback data.
     :return: InlineKeyboardMarkup object with buttons in rows of 2.
     """
     # Initialize the InlineKeyboardBuilder
     keyboard = InlineKeyboardBuilder()
-    id = await dataPostgres.get_id_by_file_id(file_id)
     # Add two buttons: one for 0% vocals and one for 15% vocals
     keyboard.add(
         InlineKeyboardButton(text="0%", callback_data=f"mix_vocals:{id}:0"),
@@ -21,3 +20,15 @@ async def percent_choose(file_id: str):
 
     # Adjust the buttons in rows of 2
     return keyboard.adjust(2).as_markup()
+
+
+async def profile_choose():
+    """
+    Creates an InlineKeyboardMarkup with a button for every output profile.
+
+    :return: InlineKeyboardMarkup object with buttons in rows of 2.
+    """
+    keyboard = InlineKeyboardBuilder()
+    for name, settings in PROFILES.items():
+        keyboard.add(InlineKeyboardButton(text=settings['label'], callback_data=f"profile:{name}"))
+    return keyboard.adjust(2).as_markup()
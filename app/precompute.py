@@ -0,0 +1,117 @@
+import os
+import shutil
+import logging
+import asyncio
+from collections import Counter
+from aiogram import Bot
+from aiogram.types import FSInputFile
+from run import process_audio_file
+from separation import batching_separator
+import data.connection as dataPostgres
+import app.admission as admission
+import governor
+import memory_watchdog
+
+# Idle-time precompute of popular songs.
+# When nobody is waiting, the missing percentages of the most requested songs
+# are made in the background and uploaded to PRECOMPUTE_CHAT_ID, so later
+# requests are answered by forwarding. Interactive jobs cancel it right away,
+# unless its result is already being uploaded.
+
+PRECOMPUTE_CHAT_ID = os.getenv('PRECOMPUTE_CHAT_ID')  # Storage chat for precomputed songs, disabled if unset
+PRECOMPUTE_INTERVAL = int(os.getenv('PRECOMPUTE_INTERVAL', 30))  # Seconds between idle checks
+PRECOMPUTE_MIN_REQUESTS = int(os.getenv('PRECOMPUTE_MIN_REQUESTS', 2))  # Requests before a song counts as popular
+PRECOMPUTE_TOP = 20  # Most requested songs looked at per check
+MAX_REMEMBERED_REQUESTS = 1000
+PERCENTAGES = [0, 15, 50]
+
+request_counts = Counter()  # file_id -> number of percentage requests
+current_task = None
+yielded = False  # Set when current_task was cancelled for an interactive job
+uploading = False  # current_task is uploading its result, which is recorded rather than cancelled
+
+def record_request(file_id: str):
+    request_counts[file_id] += 1
+    if len(request_counts) > MAX_REMEMBERED_REQUESTS:
+        # Drop the least requested other song, the oldest one on ties
+        least = min((key for key in request_counts if key != file_id), key=request_counts.__getitem__)
+        del request_counts[least]
+
+def yield_to_interactive():
+    """Cancel the running precompute job so an interactive job gets the worker."""
+    global yielded
+    if current_task and not current_task.done() and not uploading:
+        yielded = True
+        logging.info("Cancelling precompute job for an interactive job.")
+        current_task.cancel()
+
+async def find_candidate():
+    """The most requested song that still misses a percentage, as (file_id, percentage)."""
+    for file_id, count in request_counts.most_common(PRECOMPUTE_TOP):
+        if count < PRECOMPUTE_MIN_REQUESTS:
+            break
+        missing = await dataPostgres.get_missing_percentages(file_id, PERCENTAGES)
+        if missing:
+            return file_id, missing[0]
+    return None, None
+
+async def precompute(bot: Bot, file_id: str, vocal_percentage: int):
+    global uploading
+    id_input = await dataPostgres.get_id_by_file_id(file_id)
+    file_name = await dataPostgres.get_name_by_id(file_id)
+    # Separate folders, so an interactive job for the same song does not collide
+    save_directory = f'./inputSongs{vocal_percentage}:{id_input}:precompute'
+    os.makedirs(save_directory, exist_ok=True)
+    # Counted in the memory budget and CPU slots like an interactive job
+    reservation = memory_watchdog.reserve(admission.get_duration(file_id))
+    usage = governor.start_job()
+    try:
+        file_path = os.path.join(save_directory, file_name)
+        file = await bot.get_file(file_id)
+        await asyncio.wait_for(bot.download_file(file.file_path, destination=file_path), timeout=600)
+
+        processed_audio_file, _ = await process_audio_file(file_path, vocal_percentage, save_directory)
+        # A cancel during the upload would leave an unrecorded message in PRECOMPUTE_CHAT_ID
+        uploading = True
+        sendFile = await asyncio.wait_for(bot.send_audio(chat_id=PRECOMPUTE_CHAT_ID, audio=FSInputFile(processed_audio_file)), timeout=240)
+        id = await dataPostgres.insert_chat_and_message_id(sendFile.chat.id, sendFile.message_id, vocal_percentage)
+        await dataPostgres.update_out_id_by_percent(file_id, id, vocal_percentage)
+        logging.info(f"Precomputed {file_name} with vocal percentage {vocal_percentage}%")
+    finally:
+        uploading = False
+        # A cancelled job may still be in a batch running in the worker, which writes into this folder
+        await batching_separator.wait_for_destination(save_directory)
+        memory_watchdog.release(reservation)
+        governor.finish_job(usage)
+        if os.path.exists(save_directory):
+            shutil.rmtree(save_directory)
+
+async def precompute_worker(bot: Bot, is_idle):
+    """Background task, is_idle() tells if no interactive job is queued or running."""
+    global current_task, yielded
+    if not PRECOMPUTE_CHAT_ID:
+        logging.info("PRECOMPUTE_CHAT_ID is not set, precompute is disabled.")
+        return
+
+    while True:
+        await asyncio.sleep(PRECOMPUTE_INTERVAL)
+        if not is_idle():
+            continue
+        file_id, vocal_percentage = await find_candidate()
+        if file_id is None or not is_idle() or not memory_watchdog.can_start(admission.get_duration(file_id)):
+            continue
+
+        yielded = False
+        current_task = asyncio.create_task(precompute(bot, file_id, vocal_percentage))
+        try:
+            await current_task
+        except asyncio.CancelledError:
+            if not yielded:
+                raise  # The worker itself is being stopped
+            logging.info(f"Precompute of {file_id} at {vocal_percentage}% yielded to an interactive job.")
+        except Exception as e:
+            logging.error(f"Error precomputing {file_id} at {vocal_percentage}%: {e}", exc_info=True)
+            # Do not pick the same song again right away
+            request_counts[file_id] = 0
+        finally:
+            current_task = None
@@ -0,0 +1,67 @@
+import os
+import logging
+import data.connection as dataPostgres
+
+# Output profiles for the processed songs.
+# Smaller profiles cut upload time to Telegram. Opus is left out on purpose:
+# send_audio only plays MP3 and M4A, other formats arrive as documents.
+# 'mix_args', if set, replaces 'args' for the vocal mixes.
+
+PROFILES = {
+    # Mixes of the default profile stay VBR (-q:a 0) as before, smaller than 320k CBR
+    'mp3_320': {'label': 'MP3 320k', 'ext': 'mp3', 'suffix': '320k', 'args': ['-c:a', 'libmp3lame', '-b:a', '320k'],
+                'mix_args': ['-c:a', 'libmp3lame', '-q:a', '0']},
+    'mp3_192': {'label': 'MP3 192k', 'ext': 'mp3', 'suffix': '192k', 'args': ['-c:a', 'libmp3lame', '-b:a', '192k']},
+    'mp3_128': {'label': 'MP3 128k', 'ext': 'mp3', 'suffix': '128k', 'args': ['-c:a', 'libmp3lame', '-b:a', '128k']},
+    'aac_128': {'label': 'AAC 128k', 'ext': 'm4a', 'suffix': 'aac128k', 'args': ['-c:a', 'aac', '-b:a', '128k']},
+}
+DEFAULT_PROFILE = 'mp3_320'  # Stored in the input_file out_{percent}_id columns
+PRESSURE_PROFILE = os.getenv('PRESSURE_PROFILE', 'mp3_128')  # Used when the queue is long
+PRESSURE_WAIT = int(os.getenv('PRESSURE_WAIT', 600))  # Queue wait (seconds) that counts as pressure
+
+if PRESSURE_PROFILE not in PROFILES:
+    raise ValueError(f"PRESSURE_PROFILE must be one of {', '.join(PROFILES)}, got {PRESSURE_PROFILE!r}")
+
+user_profiles = {}  # user_id -> profile chosen with /quality or None, cache of users.profile
+upload_stats = {}  # profile -> {'uploads', 'bytes', 'seconds'}
+
+async def get_user_profile(user_id: int):
+    """The profile the user chose with /quality, None if they did not choose one."""
+    if user_id not in user_profiles:
+        profile = await dataPostgres.get_user_profile(user_id)
+        user_profiles[user_id] = profile if profile in PROFILES else None
+    return user_profiles[user_id]
+
+def choose_profile(preferred: str, wait: float) -> str:
+    """User preference first, then a smaller profile when the queue is under pressure."""
+    if preferred:
+        return preferred
+    if wait > PRESSURE_WAIT:
+        return PRESSURE_PROFILE
+    return DEFAULT_PROFILE
+
+async def set_user_profile(user_id: int, user_name: str, profile: str):
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown output profile: {profile}")
+    await dataPostgres.set_user_profile(user_id, user_name, profile)
+    user_profiles[user_id] = profile
+
+def record_upload(profile: str, size: int, seconds: float):
+    stats = upload_stats.setdefault(profile, {'uploads': 0, 'bytes': 0, 'seconds': 0.0})
+    stats['uploads'] += 1
+    stats['bytes'] += size
+    stats['seconds'] += seconds
+    logging.info(f"Uploaded {size / (1024 * 1024):.2f} MB as {profile} in {seconds:.2f} seconds.")
+
+def upload_report() -> str:
+    if not upload_stats:
+        return "No uploads yet."
+    lines = []
+    for profile, stats in upload_stats.items():
+        uploads = stats['uploads']
+        lines.append(
+            f"{PROFILES[profile]['label']}: {uploads} uploads, "
+            f"avg {stats['bytes'] / uploads / (1024 * 1024):.2f} MB, "
+            f"avg {stats['seconds'] / uploads:.2f} s"
+        )
+    return "\n".join(lines)
@@ -1,16 +1,25 @@
+import os
 import psycopg
 from psycopg import sql
 import logging
+import asyncio
+
+DB_SETTINGS = {
+    'user': os.getenv('DB_USER', 'postgres'),
+    'password': os.getenv('DB_PASSWORD', 'Th1nkeRLDMUsmonov'),
+    'host': os.getenv('DB_HOST', 'localhost'),
+    'port': os.getenv('DB_PORT', '5432'),
+    'dbname': os.getenv('DB_NAME', 'postgres'),
+}
+
+USER_FLUSH_INTERVAL = 5  # Seconds between batched user upserts
+pending_users = {}  # user_id -> user_name, written by user_upsert_writer
+shared_conn = None
+shared_conn_lock = asyncio.Lock()
 
 # Async connection creation for psycopg3
 async def get_db_connection():
-    conn = await psycopg.AsyncConnection.connect(
-        user="postgres",
-        password="Th1nkeRLDMUsmonov",
-        host="localhost",
-        port="5432",
-        dbname="postgres"
-    )
+    conn = await psycopg.AsyncConnection.connect(**DB_SETTINGS)
     
     # Set client encoding to UTF-8
     async with conn.cursor() as cursor:
@@ -18,58 +27,102 @@ async def get_db_connection():
     
     return conn
 
-async def insert_user_if_not_exists(user_id: int, user_name: str):
+# Long-lived autocommit connection for the hot paths, so they cost a single round trip
+async def get_shared_connection():
+    global shared_conn
+    async with shared_conn_lock:
+        if shared_conn is None or shared_conn.closed:
+            shared_conn = await psycopg.AsyncConnection.connect(**DB_SETTINGS, client_encoding="UTF8", autocommit=True)
+        return shared_conn
+
+async def check_input_file_index():
+    """
+    Raises if input_file has no unique index on file_id, which upsert_input_file's ON CONFLICT needs.
+    Create it with python -m data.migrate_input_file_unique.
+    """
+    query = """
+        SELECT EXISTS (
+            SELECT 1
+            FROM pg_index i
+            JOIN pg_class t ON t.oid = i.indrelid
+            JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = i.indkey[0]
+            WHERE t.relname = 'input_file' AND i.indisunique AND i.indnatts = 1 AND a.attname = 'file_id'
+        );
+    """
     conn = await get_db_connection()
     try:
         async with conn.cursor() as cur:
-            # Insert the user, or update the user_name if the user_id already exists
-            await cur.execute(
-                """
-                INSERT INTO users (user_id, user_name)
-                VALUES (%s, %s)
-                ON CONFLICT (user_id) DO UPDATE
-                SET user_name = EXCLUDED.user_name;
-                """,
-                (user_id, user_name)
-            )
-            # Commit the transaction to make sure the insertion or update is saved
-            await conn.commit()
-            logging.info(f"User with ID {user_id} inserted or updated.")
-    except Exception as e:
-        logging.error(f"Error inserting or updating user: {e}")
+            await cur.execute(query)
+            result = await cur.fetchone()
     finally:
-        # Ensure the connection is closed
         await conn.close()
+    if not result[0]:
+        raise RuntimeError(
+            "input_file has no unique index on file_id. "
+            "Run python -m data.migrate_input_file_unique before starting the bot."
+        )
 
+async def upsert_input_file(file_id: str, file_name: str):
+    """
+    Inserts the file into input_file if it is not there yet and returns its id in one statement.
 
+    :param file_id: Telegram file identifier.
+    :param file_name: Formatted file name stored for new rows.
+    :return: The id of the input_file row, or None on error.
+    """
+    # The no-op update makes RETURNING give the existing row's id on conflict
+    query = """
+        INSERT INTO input_file (file_id, file_name)
+        VALUES (%s, %s)
+        ON CONFLICT (file_id) DO UPDATE SET file_id = EXCLUDED.file_id
+        RETURNING id;
+    """
+    try:
+        conn = await get_shared_connection()
+        async with conn.cursor() as cur:
+            await cur.execute(query, (file_id, file_name))
+            result = await cur.fetchone()
+            return result[0] if result else None
+    except Exception as e:
+        logging.error(f"Error upserting input_file for file_id {file_id}: {e}")
+        return None
 
-async def check_file_exists(file_id: str) -> bool:
-    conn = await get_db_connection()
+def queue_user_upsert(user_id: int, user_name: str):
+    """Remember the user, the row is written by user_upsert_writer off the request path."""
+    pending_users[user_id] = user_name
+
+async def flush_user_upserts():
+    global pending_users
+    if not pending_users:
+        return
+    users, pending_users = pending_users, {}
     try:
+        conn = await get_shared_connection()
         async with conn.cursor() as cur:
-            # Execute a query to check if the file_id exists in the input_file table
-            await cur.execute(
+            # executemany pipelines the rows, so the whole batch is one round trip
+            await cur.executemany(
                 """
-                SELECT EXISTS (
-                    SELECT 1
-                    FROM input_file
-                    WHERE file_id = %s
-                );
+                INSERT INTO users (user_id, user_name)
+                VALUES (%s, %s)
+                ON CONFLICT (user_id) DO UPDATE
+                SET user_name = EXCLUDED.user_name;
                 """,
-                (file_id,)
+                list(users.items())
             )
-            # Fetch the result
-            result = await cur.fetchone()
-            # Extract the boolean value from the result
-            file_exists = result[0]
-            return file_exists
+        logging.info(f"Inserted or updated {len(users)} users.")
     except Exception as e:
-        logging.error(f"Error checking file existence: {e}")
-        return False
-    finally:
-        # Ensure the connection is closed
-        await conn.close()
+        logging.error(f"Error inserting or updating users: {e}")
+        # Keep the users for the next attempt, newer names win
+        pending_users = {**users, **pending_users}
 
+async def user_upsert_writer():
+    """Background task writing queued user upserts in batches."""
+    try:
+        while True:
+            await asyncio.sleep(USER_FLUSH_INTERVAL)
+            await flush_user_upserts()
+    finally:
+        await flush_user_upserts()
 
 async def get_message_id_by_id(record_id: int):
     conn = await get_db_connection()  # Assuming you have get_db_connection() defined
@@ -100,26 +153,6 @@ async def get_message_id_by_id(record_id: int):
         await conn.close()
 
 
-async def insert_into_input_file(file_id: str, file_name: str):
-    conn = await get_db_connection()  # Assuming you have get_db_connection() defined
-    try:
-        async with conn.cursor() as cur:
-            # Insert into the input_file table
-            await cur.execute(
-                """
-                INSERT INTO input_file (file_id, file_name)
-                VALUES (%s, %s);
-                """,
-                (file_id, file_name)
-            )
-            await conn.commit()  # Commit the transaction to save the data
-            logging.info(f"Inserted into input_file: file_id={file_id}")
-    except Exception as e:
-        logging.error(f"Error inserting into input_file: {e}")
-    finally:
-        await conn.close()  # Ensure the connection is closed
-
-
 async def check_file_exists_with_percentage(file_id: str, percent: int) -> bool:
 
     conn = await get_db_connection()
@@ -371,4 +404,139 @@ async def get_user_ids():
         logging.error(f"Error retrieving user_ids: {e}")
         return []
     finally:
-        await conn.close()
\ No newline at end of file
+        await conn.close()
+
+async def create_profile_output_table():
+    """
+    Creates the table caching outputs of non-default output profiles.
+    Outputs of the default profile stay in the input_file out_{percent}_id columns.
+    """
+    query = """
+        CREATE TABLE IF NOT EXISTS profile_output (
+            file_id TEXT NOT NULL,
+            percent INTEGER NOT NULL,
+            profile TEXT NOT NULL,
+            chat_id BIGINT NOT NULL,
+            message_id BIGINT NOT NULL,
+            PRIMARY KEY (file_id, percent, profile)
+        );
+    """
+    conn = await get_db_connection()
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute(query)
+            await conn.commit()
+    except Exception as e:
+        logging.error(f"Error creating profile_output table: {e}")
+    finally:
+        await conn.close()
+
+async def create_user_profile_column():
+    """Adds the output profile chosen with /quality to the users table."""
+    conn = await get_db_connection()
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS profile TEXT;")
+            await conn.commit()
+    except Exception as e:
+        logging.error(f"Error adding the profile column to users: {e}")
+    finally:
+        await conn.close()
+
+async def get_user_profile(user_id: int):
+    """
+    Retrieves the output profile the user chose with /quality.
+
+    :return: The profile name, or None if the user did not choose one.
+    """
+    query = """
+        SELECT profile
+        FROM users
+        WHERE user_id = %s;
+    """
+    try:
+        conn = await get_shared_connection()
+        async with conn.cursor() as cur:
+            await cur.execute(query, (user_id,))
+            result = await cur.fetchone()
+            return result[0] if result else None
+    except Exception as e:
+        logging.error(f"Error retrieving the profile of user {user_id}: {e}")
+        return None
+
+async def set_user_profile(user_id: int, user_name: str, profile: str):
+    query = """
+        INSERT INTO users (user_id, user_name, profile)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (user_id) DO UPDATE
+        SET profile = EXCLUDED.profile;
+    """
+    try:
+        conn = await get_shared_connection()
+        async with conn.cursor() as cur:
+            await cur.execute(query, (user_id, user_name, profile))
+            logging.info(f"Stored profile {profile} for user {user_id}.")
+    except Exception as e:
+        logging.error(f"Error storing the profile of user {user_id}: {e}")
+
+async def get_profile_output(file_id: str, percent: int, profile: str):
+    """
+    Retrieves the chat_id and message_id of a cached output for a non-default profile.
+
+    :return: (chat_id, message_id), or (None, None) if the output was not made yet.
+    """
+    query = """
+        SELECT chat_id, message_id
+        FROM profile_output
+        WHERE file_id = %s AND percent = %s AND profile = %s;
+    """
+    try:
+        conn = await get_shared_connection()
+        async with conn.cursor() as cur:
+            await cur.execute(query, (file_id, percent, profile))
+            result = await cur.fetchone()
+            return result if result else (None, None)
+    except Exception as e:
+        logging.error(f"Error retrieving {profile} output for file_id {file_id}: {e}")
+        return None, None
+
+async def insert_profile_output(file_id: str, percent: int, profile: str, chat_id: int, message_id: int):
+    query = """
+        INSERT INTO profile_output (file_id, percent, profile, chat_id, message_id)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (file_id, percent, profile) DO UPDATE
+        SET chat_id = EXCLUDED.chat_id, message_id = EXCLUDED.message_id;
+    """
+    try:
+        conn = await get_shared_connection()
+        async with conn.cursor() as cur:
+            await cur.execute(query, (file_id, percent, profile, chat_id, message_id))
+            logging.info(f"Stored {profile} output for file_id {file_id} at {percent}%.")
+    except Exception as e:
+        logging.error(f"Error storing {profile} output for file_id {file_id}: {e}")
+
+async def get_missing_percentages(file_id: str, percentages) -> list:
+    """
+    Retrieves the percentages that have no output yet for the given file_id.
+
+    :param file_id: The file identifier to search for.
+    :param percentages: The percentages to check, each needs an out_{percent}_id column.
+    :return: List of percentages without output, or an empty list on error.
+    """
+    columns = ", ".join(f"out_{percent}_id" for percent in percentages)
+    query = f"""
+        SELECT {columns}
+        FROM input_file
+        WHERE file_id = %s;
+    """
+    try:
+        conn = await get_shared_connection()
+        async with conn.cursor() as cur:
+            await cur.execute(query, (file_id,))
+            result = await cur.fetchone()
+            if not result:
+                return []
+            return [percent for percent, out_id in zip(percentages, result) if not out_id]
+    except Exception as e:
+        logging.error(f"Error retrieving missing percentages for file_id {file_id}: {e}")
+        return []
@@ -0,0 +1,37 @@
+import asyncio
+import logging
+from dotenv import load_dotenv
+
+# One-off migration adding the unique index on input_file.file_id.
+# The earlier check-then-insert could store the same file_id twice, so
+# duplicate rows are removed first, keeping the oldest row of each file_id.
+#
+# Usage (from the repository root, with the bot stopped):
+#   python -m data.migrate_input_file_unique
+
+load_dotenv()
+
+import data.connection as dataPostgres
+
+async def main():
+    conn = await dataPostgres.get_db_connection()
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """
+                DELETE FROM input_file a
+                USING input_file b
+                WHERE a.file_id = b.file_id AND a.id > b.id;
+                """
+            )
+            logging.info(f"Deleted {cur.rowcount} duplicate input_file rows.")
+            await cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS input_file_file_id_key ON input_file (file_id);")
+        await conn.commit()
+        logging.info("Unique index on input_file.file_id is in place.")
+    finally:
+        await conn.close()
+    await dataPostgres.check_input_file_index()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
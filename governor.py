@@ -0,0 +1,95 @@
+import os
+import re
+import shutil
+import time
+import logging
+import contextvars
+
+# CPU resource governor.
+# Splits the cores between the TensorFlow model (one batched pass at a time)
+# and the ffmpeg processes of the jobs running next to it, so overlapping
+# jobs do not oversubscribe the machine. Also counts CPU time per job.
+
+if hasattr(os, 'sched_getaffinity'):
+    CPUS = sorted(os.sched_getaffinity(0))
+else:
+    CPUS = list(range(os.cpu_count() or 1))
+
+MAX_CONCURRENT_JOBS = int(os.getenv('MAX_CONCURRENT_JOBS', 4))  # Jobs in flight, lets separation batch them
+FFMPEG_THREADS = int(os.getenv('FFMPEG_THREADS', 1))  # Per ffmpeg process, libmp3lame encodes on one thread
+# At most the other MAX_CONCURRENT_JOBS - 1 jobs run ffmpeg next to a model pass, never more than a quarter of the cores
+FFMPEG_CPUS = min((MAX_CONCURRENT_JOBS - 1) * FFMPEG_THREADS, len(CPUS) // 4)
+TF_THREADS = int(os.getenv('TF_THREADS', max(1, len(CPUS) - FFMPEG_CPUS)))  # Intra-op threads of the model, the rest
+TF_INTER_OP_THREADS = int(os.getenv('TF_INTER_OP_THREADS', 2))
+PIN_CPUS = os.getenv('PIN_CPUS', '0') == '1'  # Pin the model and every job slot to their own cores
+TASKSET = shutil.which('taskset')  # util-linux, pins the ffmpeg processes
+
+if PIN_CPUS and not TASKSET:
+    logging.warning("PIN_CPUS is set but taskset is not installed, ffmpeg processes are not pinned.")
+
+free_slots = list(range(MAX_CONCURRENT_JOBS))
+current_job = contextvars.ContextVar('current_job', default=None)
+
+def configure_tensorflow():
+    """Set the TensorFlow thread pools. Must run before TensorFlow is imported."""
+    os.environ.setdefault('TF_NUM_INTRAOP_THREADS', str(TF_THREADS))
+    os.environ.setdefault('TF_NUM_INTEROP_THREADS', str(TF_INTER_OP_THREADS))
+    os.environ.setdefault('OMP_NUM_THREADS', str(TF_THREADS))
+    if PIN_CPUS and hasattr(os, 'sched_setaffinity'):
+        # ffmpeg children get their own cores in slot_cpus
+        os.sched_setaffinity(0, model_cpus())
+    logging.info(f"TensorFlow threads: intra-op {TF_THREADS}, inter-op {TF_INTER_OP_THREADS}. ffmpeg threads: {FFMPEG_THREADS}.")
+
+def model_cpus():
+    return CPUS[:TF_THREADS]
+
+def slot_cpus(slot: int):
+    job_cpus = CPUS[TF_THREADS:] or CPUS
+    start = (slot * FFMPEG_THREADS) % len(job_cpus)
+    return [job_cpus[(start + i) % len(job_cpus)] for i in range(min(FFMPEG_THREADS, len(job_cpus)))]
+
+def start_job():
+    """Give the current job a slot and start counting its CPU time."""
+    usage = {
+        'slot': free_slots.pop(0) if free_slots else None,
+        'ffmpeg': 0.0,
+        'separation': 0.0,
+        'started_at': time.time(),
+    }
+    current_job.set(usage)
+    return usage
+
+def finish_job(usage):
+    if usage['slot'] is not None:
+        free_slots.append(usage['slot'])
+    elapsed = time.time() - usage['started_at']
+    cpu = usage['ffmpeg'] + usage['separation']
+    logging.info(
+        f"Job CPU time: {cpu:.2f} s (ffmpeg {usage['ffmpeg']:.2f} s, separation {usage['separation']:.2f} s) "
+        f"in {elapsed:.2f} s wall time."
+    )
+
+def add_cpu_time(kind: str, seconds: float):
+    usage = current_job.get()
+    if usage is not None:
+        usage[kind] += seconds
+
+def ffmpeg_args():
+    """Extra ffmpeg output options: thread budget and CPU time report on stderr."""
+    return ['-threads', str(FFMPEG_THREADS), '-benchmark']
+
+def ffmpeg_command():
+    """
+    The ffmpeg command, prefixed with taskset pinning it to the cores of the current job slot.
+    taskset sets the affinity before ffmpeg starts, without running Python in a forked child.
+    """
+    usage = current_job.get()
+    if not PIN_CPUS or usage is None or usage['slot'] is None or not TASKSET:
+        return ['ffmpeg']
+    return [TASKSET, '-c', ','.join(str(cpu) for cpu in slot_cpus(usage['slot'])), 'ffmpeg']
+
+def record_ffmpeg_cpu(stderr: str):
+    """Add the utime and stime printed by ffmpeg -benchmark to the current job."""
+    match = re.search(r'bench: utime=([\d.]+)s stime=([\d.]+)s', stderr)
+    if match:
+        add_cpu_time('ffmpeg', float(match.group(1)) + float(match.group(2)))
@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import asyncio
+import itertools
+from aiohttp import web
+
+# Local stand-in for the Telegram Bot API, implementing the methods the bot uses.
+# Point aiogram at it with TelegramAPIServer.from_base(api.base_url).
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "MinusGolos", "username": "minus_golos_loadtest_bot"}
+
+class FakeBotAPI:
+    def __init__(self, host: str = '127.0.0.1', port: int = 8081):
+        self.host = host
+        self.port = port
+        self.updates = []  # Updates not yet confirmed by getUpdates offset
+        self.new_updates = asyncio.Event()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.files = {}  # file_id -> local path served by getFile and file downloads
+        self.messages = {}  # (chat_id, message_id) -> message
+        self.listeners = []  # Called as listener(method, params, result) after every API call
+        self.runner = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route('*', '/bot{token}/{method}', self.handle_method)
+        app.router.add_get('/file/bot{token}/{path:.+}', self.handle_file)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def add_file(self, file_id: str, path: str):
+        self.files[file_id] = path
+
+    def push_update(self, kind: str, payload: dict) -> dict:
+        """Queue an update (kind is 'message' or 'callback_query') for the next getUpdates."""
+        update = {'update_id': next(self.update_ids), kind: payload}
+        self.updates.append(update)
+        self.new_updates.set()
+        return update
+
+    @staticmethod
+    def user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+    @staticmethod
+    def chat(chat_id: int) -> dict:
+        return {"id": chat_id, "type": "private", "first_name": f"user{chat_id}"}
+
+    def audio_message(self, user_id: int, file_id: str, duration: int, file_name: str) -> dict:
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": self.chat(user_id),
+            "from": self.user(user_id),
+            "audio": {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "duration": duration,
+                "file_name": file_name,
+                "mime_type": "audio/mpeg",
+                "file_size": self.file_size(file_id),
+            },
+        }
+
+    def callback_query(self, user_id: int, message: dict, data: str) -> dict:
+        return {
+            "id": str(next(self.update_ids)),
+            "from": self.user(user_id),
+            "chat_instance": str(user_id),
+            "message": message,
+            "data": data,
+        }
+
+    def file_size(self, file_id: str) -> int:
+        return os.path.getsize(self.files[file_id])
+
+    def new_message(self, chat_id: int, **fields) -> dict:
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": self.chat(chat_id),
+            "from": BOT_USER,
+            **fields,
+        }
+        self.messages[(chat_id, message["message_id"])] = message
+        return message
+
+    async def handle_method(self, request):
+        method = request.match_info['method']
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        handler = getattr(self, f'api_{method}', None)
+        # Methods the bot only needs a success for (deleteMessage, answerCallbackQuery, ...)
+        result = await handler(params) if handler else True
+        for listener in self.listeners:
+            listener(method, params, result)
+        return web.json_response({'ok': True, 'result': result})
+
+    async def handle_file(self, request):
+        file_id = os.path.splitext(os.path.basename(request.match_info['path']))[0]
+        if file_id not in self.files:
+            raise web.HTTPNotFound()
+        return web.FileResponse(self.files[file_id])
+
+    async def api_getMe(self, params):
+        return BOT_USER
+
+    async def api_getUpdates(self, params):
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        self.updates = [update for update in self.updates if update['update_id'] >= offset]
+        if not self.updates and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(self.updates)
+
+    async def api_getFile(self, params):
+        file_id = params['file_id']
+        return {
+            "file_id": file_id,
+            "file_unique_id": file_id,
+            "file_size": self.file_size(file_id),
+            "file_path": f"music/{file_id}.mp3",
+        }
+
+    async def api_sendMessage(self, params):
+        fields = {"text": params.get('text', '')}
+        if params.get('reply_markup'):
+            fields["reply_markup"] = json.loads(params['reply_markup'])
+        return self.new_message(int(params['chat_id']), **fields)
+
+    async def api_editMessageText(self, params):
+        key = (int(params['chat_id']), int(params['message_id']))
+        message = self.messages.get(key) or self.new_message(key[0])
+        message = {**message, "text": params.get('text', ''), "edit_date": int(time.time())}
+        message.pop("reply_markup", None)
+        if params.get('reply_markup'):
+            message["reply_markup"] = json.loads(params['reply_markup'])
+        self.messages[key] = message
+        return message
+
+    async def api_sendPhoto(self, params):
+        return self.new_message(int(params['chat_id']), caption=params.get('caption', ''))
+
+    async def api_sendAudio(self, params):
+        audio = params['audio']
+        # aiogram uploads files as audio=attach://<field>, with the bytes in that form field
+        if isinstance(audio, str) and audio.startswith('attach://'):
+            audio = params[audio[len('attach://'):]]
+        audio.file.seek(0, os.SEEK_END)
+        size = audio.file.tell()
+        file_id = f"out{next(self.message_ids)}"
+        return self.new_message(
+            int(params['chat_id']),
+            audio={"file_id": file_id, "file_unique_id": file_id, "duration": 0, "file_size": size},
+        )
+
+    async def api_forwardMessage(self, params):
+        original = self.messages.get((int(params['from_chat_id']), int(params['message_id'])), {})
+        fields = {key: value for key, value in original.items() if key in ('audio', 'text')}
+        return self.new_message(int(params['chat_id']), **fields)
@@ -0,0 +1,256 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+from loadtest.fake_bot_api import FakeBotAPI
+from loadtest.postgres import DisposablePostgres
+
+# End-to-end load test.
+# Runs the real Dispatcher, AudioFileMiddleware and router against a local fake
+# Bot API and a disposable PostgreSQL, sends synthetic songs at increasing
+# rates and reports latencies and the max sustainable songs/hour.
+#
+# Usage (from the repository root, as a normal user):
+#   python -m loadtest.load_test --rates 60,120,240 --stage-seconds 600
+
+FINAL_OUTCOMES = ('sent', 'forwarded', 'rejected', 'failed')
+
+class SongRun:
+    def __init__(self, user_id: int, file_id: str, percentage: int, submitted_at: float):
+        self.user_id = user_id
+        self.file_id = file_id
+        self.percentage = percentage
+        self.submitted_at = submitted_at
+        self.update_ids = set()
+        self.delivered_at = {}  # update_id -> time the bot fetched it
+        self.update_latencies = []  # Time from fetching an update to the bot's first reaction
+        self.chosen_at = None
+        self.done_at = None
+        self.outcome = None
+        self.upload_bytes = 0
+
+class LoadTest:
+    def __init__(self, api: FakeBotAPI, args):
+        self.api = api
+        self.args = args
+        self.runs = {}  # user_id (= chat_id) -> SongRun
+        self.update_runs = {}  # update_id -> SongRun
+        self.audio_files = {}  # duration -> synthetic audio file
+        self.file_ids = []  # file_ids sent so far, reused for popular songs
+        self.user_ids = iter(range(10_000_000, 20_000_000))
+        api.listeners.append(self.on_api_call)
+
+    async def make_audio_files(self, directory: str):
+        for duration in self.args.durations:
+            if self.args.audio:
+                path = self.args.audio
+            else:
+                path = os.path.join(directory, f'synthetic_{duration}s.mp3')
+                process = await asyncio.create_subprocess_exec(
+                    'ffmpeg', '-y', '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+                    '-f', 'lavfi', '-i', f'anoisesrc=amplitude=0.1:duration={duration}',
+                    '-filter_complex', 'amix=inputs=2', '-ac', '2', '-ar', '44100', '-b:a', '192k', path,
+                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+                )
+                stdout, stderr = await process.communicate()
+                if process.returncode != 0:
+                    raise RuntimeError(f"FFmpeg synthesis error: {stderr.decode()}")
+            self.audio_files[duration] = path
+
+    def submit_song(self) -> SongRun:
+        user_id = next(self.user_ids)
+        if self.file_ids and random.random() < self.args.repeat_ratio:
+            file_id, duration = random.choice(self.file_ids)
+        else:
+            duration = random.choice(self.args.durations)
+            file_id = f"song{len(self.file_ids)}"
+            self.file_ids.append((file_id, duration))
+            self.api.add_file(file_id, self.audio_files[duration])
+
+        run = SongRun(user_id, file_id, random.choice(self.args.percentages), time.time())
+        self.runs[user_id] = run
+        message = self.api.audio_message(user_id, file_id, duration, f"Synthetic Song {file_id}.mp3")
+        self.track_update(run, self.api.push_update('message', message))
+        return run
+
+    def track_update(self, run: SongRun, update: dict):
+        run.update_ids.add(update['update_id'])
+        self.update_runs[update['update_id']] = run
+
+    def react(self, run: SongRun):
+        """Record the bot's first reaction to the updates of this run fetched so far."""
+        now = time.time()
+        for update_id, delivered_at in list(run.delivered_at.items()):
+            run.update_latencies.append(now - delivered_at)
+            del run.delivered_at[update_id]
+
+    def finish(self, run: SongRun, outcome: str):
+        if run.outcome is None:
+            run.outcome = outcome
+            run.done_at = time.time()
+
+    def on_api_call(self, method: str, params: dict, result):
+        if method == 'getUpdates':
+            now = time.time()
+            for update in result:
+                run = self.update_runs.pop(update['update_id'], None)
+                if run:
+                    run.delivered_at[update['update_id']] = now
+            return
+
+        chat_id = params.get('chat_id')
+        run = self.runs.get(int(chat_id)) if chat_id else None
+        if run is None or run.outcome:
+            return
+        self.react(run)
+
+        text = params.get('text', '')
+        if method == 'sendMessage' and result.get('reply_markup'):
+            buttons = [button for row in result['reply_markup']['inline_keyboard'] for button in row]
+            data = next((button['callback_data'] for button in buttons if button['callback_data'].endswith(f":{run.percentage}")), None)
+            if data is None:
+                self.finish(run, 'failed')
+                return
+            run.chosen_at = time.time()
+            self.track_update(run, self.api.push_update('callback_query', self.api.callback_query(run.user_id, result, data)))
+        elif method in ('sendMessage', 'editMessageText') and 'busy' in text:
+            self.finish(run, 'rejected')
+        elif method == 'sendMessage' and text:
+            # Replies without a keyboard are errors: too big, too long, failed to process
+            self.finish(run, 'failed')
+        elif method == 'sendAudio':
+            run.upload_bytes = result['audio']['file_size']
+            self.finish(run, 'sent')
+        elif method == 'forwardMessage':
+            self.finish(run, 'forwarded')
+
+    async def run_stage(self, rate: float):
+        """Send songs as a Poisson process at rate songs/hour, then wait for them to finish."""
+        runs = []
+        started_at = time.time()
+        end = started_at + self.args.stage_seconds
+        while True:
+            await asyncio.sleep(random.expovariate(rate / 3600))
+            if time.time() > end:
+                break
+            runs.append(self.submit_song())
+
+        drain_end = time.time() + self.args.drain_seconds
+        while any(run.outcome is None for run in runs) and time.time() < drain_end:
+            await asyncio.sleep(1)
+        return runs, time.time() - started_at
+
+def percentile(values, p: float):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def report_stage(rate: float, runs, elapsed: float, max_p95: float) -> bool:
+    """Print the stage results and return True if the rate was sustained."""
+    counts = {outcome: sum(run.outcome == outcome for run in runs) for outcome in FINAL_OUTCOMES}
+    unfinished = sum(run.outcome is None for run in runs)
+    completed = [run for run in runs if run.outcome in ('sent', 'forwarded')]
+    update_latencies = [latency for run in runs for latency in run.update_latencies]
+    job_latencies = [run.done_at - run.chosen_at for run in completed if run.chosen_at]
+    uploaded = [run.upload_bytes for run in completed if run.outcome == 'sent']
+
+    print(f"\nStage {rate:g} songs/hour ({elapsed:.0f} s)")
+    print(f"  submitted {len(runs)}, sent {counts['sent']}, forwarded {counts['forwarded']}, "
+          f"rejected {counts['rejected']}, failed {counts['failed']}, unfinished {unfinished}")
+    print(f"  update handling latency: p50 {percentile(update_latencies, 50):.3f} s, "
+          f"p95 {percentile(update_latencies, 95):.3f} s, max {percentile(update_latencies, 100):.3f} s")
+    print(f"  job completion latency: p50 {percentile(job_latencies, 50):.1f} s, "
+          f"p95 {percentile(job_latencies, 95):.1f} s, p99 {percentile(job_latencies, 99):.1f} s")
+    print(f"  throughput: {len(completed) / elapsed * 3600:.1f} songs/hour, "
+          f"uploaded {sum(uploaded) / (1024 * 1024):.1f} MB")
+
+    return bool(runs) and len(completed) == len(runs) and percentile(job_latencies, 95) <= max_p95
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Load test the bot against a local fake Telegram Bot API.")
+    parser.add_argument('--rates', default='60,120,240', help="Comma separated arrival rates in songs/hour, one stage each")
+    parser.add_argument('--stage-seconds', type=float, default=600, help="How long songs are sent in each stage")
+    parser.add_argument('--drain-seconds', type=float, default=900, help="How long to wait for a stage's songs to finish")
+    parser.add_argument('--durations', default='60,180,300', help="Comma separated song durations in seconds")
+    parser.add_argument('--percentages', default='0,15,50', help="Comma separated vocal percentages users choose from")
+    parser.add_argument('--repeat-ratio', type=float, default=0.2, help="Share of songs that repeat an earlier file_id")
+    parser.add_argument('--max-p95', type=float, default=600, help="p95 job completion latency (s) a sustained rate must keep")
+    parser.add_argument('--audio', help="Use this audio file for every song instead of synthetic audio")
+    parser.add_argument('--port', type=int, default=8081, help="Port of the fake Bot API")
+    parser.add_argument('--pg-bin', help="Directory with initdb and pg_ctl")
+    args = parser.parse_args(argv)
+    args.rates = [float(rate) for rate in args.rates.split(',')]
+    args.durations = [int(duration) for duration in args.durations.split(',')]
+    args.percentages = [int(percentage) for percentage in args.percentages.split(',')]
+    return args
+
+async def run_load_test(api: FakeBotAPI, args):
+    from aiogram import Bot, Dispatcher
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from app.handlers import router
+    from middlewares.middlewares import AudioFileMiddleware
+    import data.connection as dataPostgres
+    from separation import batching_separator
+
+    load_test = LoadTest(api, args)
+    bot = Bot(token='123456:loadtest', session=AiohttpSession(api=TelegramAPIServer.from_base(api.base_url)))
+    dp = Dispatcher()
+    dp.include_router(router)
+    dp.update.middleware(AudioFileMiddleware())
+    user_writer = polling = None
+
+    sustained = []
+    try:
+        await dataPostgres.check_input_file_index()
+        await dataPostgres.create_profile_output_table()
+        await dataPostgres.create_user_profile_column()
+        batching_separator.start()
+        user_writer = asyncio.create_task(dataPostgres.user_upsert_writer())
+        polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False))
+
+        with tempfile.TemporaryDirectory(prefix='loadtest_audio_') as directory:
+            await load_test.make_audio_files(directory)
+            for rate in args.rates:
+                runs, elapsed = await load_test.run_stage(rate)
+                if report_stage(rate, runs, elapsed, args.max_p95):
+                    sustained.append(rate)
+        if sustained:
+            print(f"\nMax sustainable rate: {max(sustained):g} songs/hour")
+        else:
+            print("\nNo tested rate was sustained.")
+    finally:
+        if polling:
+            try:
+                await dp.stop_polling()
+            except RuntimeError:
+                pass  # Polling already stopped
+            await asyncio.gather(polling, return_exceptions=True)
+        if user_writer:
+            user_writer.cancel()
+            await asyncio.gather(user_writer, return_exceptions=True)
+        batching_separator.close()
+        await bot.session.close()
+
+async def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    # The cluster is stopped and deleted however the run ends
+    with DisposablePostgres(args.pg_bin) as postgres:
+        # data/connection.py reads the DB_* variables on import, so the bot modules are imported after this
+        os.environ.update(postgres.environment())
+        api = FakeBotAPI(port=args.port)
+        await api.start()
+        try:
+            await run_load_test(api, args)
+        finally:
+            await api.stop()
+
+if __name__ == '__main__':
+    asyncio.run(main(sys.argv[1:]))
@@ -0,0 +1,90 @@
+import os
+import glob
+import shutil
+import socket
+import tempfile
+import subprocess
+import psycopg
+
+# Disposable PostgreSQL cluster for load tests, created with initdb in a temp
+# directory, filled with schema.sql and deleted again on stop(). Use it as a
+# context manager, so the server is also stopped when the run fails.
+
+SCHEMA_FILE = os.path.join(os.path.dirname(__file__), 'schema.sql')
+
+def find_pg_bin(pg_bin: str = None) -> str:
+    if pg_bin:
+        return pg_bin
+    initdb = shutil.which('initdb')
+    if initdb:
+        return os.path.dirname(initdb)
+    candidates = sorted(glob.glob('/usr/lib/postgresql/*/bin/initdb'))
+    if candidates:
+        return os.path.dirname(candidates[-1])
+    raise RuntimeError("initdb not found. Install PostgreSQL or pass --pg-bin.")
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class DisposablePostgres:
+    def __init__(self, pg_bin: str = None):
+        self.bin = find_pg_bin(pg_bin)
+        self.directory = tempfile.mkdtemp(prefix='loadtest_pg_')
+        self.data = os.path.join(self.directory, 'data')
+        self.port = free_port()
+
+    def run(self, *command):
+        result = subprocess.run([os.path.join(self.bin, command[0]), *command[1:]], capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"{command[0]} failed with exit code {result.returncode}:\n{result.stderr or result.stdout}")
+
+    def start(self):
+        # initdb refuses to run as root, run the load test as a normal user
+        self.run('initdb', '-D', self.data, '-U', 'postgres', '-A', 'trust', '-E', 'UTF8')
+        log_file = os.path.join(self.directory, 'postgres.log')
+        try:
+            self.run(
+                'pg_ctl', '-D', self.data, '-l', log_file, '-w',
+                '-o', f'-p {self.port} -k {self.directory} -c listen_addresses=localhost', 'start'
+            )
+        except RuntimeError as e:
+            # pg_ctl only says to examine the log, the reason is in there
+            log = open(log_file).read() if os.path.exists(log_file) else ''
+            raise RuntimeError(f"{e}\n{log}") from None
+        with psycopg.connect(**self.settings(), autocommit=True) as conn:
+            with open(SCHEMA_FILE) as f:
+                conn.execute(f.read())
+
+    def __enter__(self):
+        try:
+            self.start()
+        except BaseException:
+            self.stop()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def settings(self) -> dict:
+        return {'user': 'postgres', 'password': '', 'host': 'localhost', 'port': str(self.port), 'dbname': 'postgres'}
+
+    def environment(self) -> dict:
+        """DB_* variables read by data/connection.py."""
+        settings = self.settings()
+        return {
+            'DB_USER': settings['user'],
+            'DB_PASSWORD': settings['password'],
+            'DB_HOST': settings['host'],
+            'DB_PORT': settings['port'],
+            'DB_NAME': settings['dbname'],
+        }
+
+    def stop(self):
+        subprocess.run(
+            [os.path.join(self.bin, 'pg_ctl'), '-D', self.data, '-m', 'fast', '-w', 'stop'],
+            capture_output=True
+        )
+        shutil.rmtree(self.directory, ignore_errors=True)
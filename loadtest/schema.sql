@@ -0,0 +1,34 @@
+-- Tables used by data/connection.py, created in the disposable load-test database.
+-- profile_output is created by the bot itself on startup.
+
+CREATE TABLE users (
+    user_id BIGINT PRIMARY KEY,
+    user_name TEXT
+);
+
+CREATE TABLE input_file (
+    id SERIAL PRIMARY KEY,
+    file_id TEXT NOT NULL UNIQUE,
+    file_name TEXT,
+    out_0_id INTEGER NOT NULL DEFAULT 0,
+    out_15_id INTEGER NOT NULL DEFAULT 0,
+    out_50_id INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE out_0 (
+    id SERIAL PRIMARY KEY,
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT NOT NULL
+);
+
+CREATE TABLE out_15 (
+    id SERIAL PRIMARY KEY,
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT NOT NULL
+);
+
+CREATE TABLE out_50 (
+    id SERIAL PRIMARY KEY,
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT NOT NULL
+);
@@ -3,14 +3,20 @@ import logging
 import os
 import shutil
 from dotenv import load_dotenv
+
+# Load .env before the app modules read their settings
+load_dotenv()
+
 from aiogram import Bot, Dispatcher
-from app.handlers import router
+from app.handlers import router, is_idle
+import app.precompute as precompute
 from middlewares.middlewares import AudioFileMiddleware
+import data.connection as dataPostgres
+from separation import batching_separator
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
 
-load_dotenv()
 TOKEN = os.getenv('TOKEN')
 # Initialize Bot and Dispatcher
 bot = Bot(token = TOKEN)
@@ -21,10 +27,23 @@ async def main():
     # Include router with your handlers
     dp.include_router(router)
     dp.update.middleware(AudioFileMiddleware())  # update
+    await dataPostgres.check_input_file_index()
+    await dataPostgres.create_profile_output_table()
+    await dataPostgres.create_user_profile_column()
+    # Load the separation model before the first song arrives
+    batching_separator.start()
+    # Write user upserts in batches off the request path
+    user_writer = asyncio.create_task(dataPostgres.user_upsert_writer())
+    # Make popular songs' other percentages while no one is waiting
+    precompute_worker = asyncio.create_task(precompute.precompute_worker(bot, is_idle))
     try:
         # Start polling
         await dp.start_polling(bot)
     finally:
+        user_writer.cancel()
+        precompute_worker.cancel()
+        await asyncio.gather(user_writer, precompute_worker, return_exceptions=True)
+        batching_separator.close()
         # Ensure the bot's session is closed on shutdown
         await bot.session.close()
         logging.info("Bot session closed.")
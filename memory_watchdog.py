@@ -0,0 +1,90 @@
+import os
+import logging
+import itertools
+
+# Memory watchdog.
+# The service runs under a systemd MemoryLimit, so jobs are only started while
+# the predicted memory fits the budget, and the separation worker is recycled
+# before TensorFlow memory growth gets the whole bot OOM-killed.
+
+MB = 1024 * 1024
+MEMORY_BUDGET = int(os.getenv('MEMORY_BUDGET_MB', 12288)) * MB  # Stay below MemoryLimit=14G
+RECYCLE_AFTER_JOBS = int(os.getenv('RECYCLE_AFTER_JOBS', 50))  # Restart the worker after this many songs
+RECYCLE_RSS = int(os.getenv('RECYCLE_RSS_MB', 6144)) * MB  # Restart the worker above this RSS
+BYTES_PER_AUDIO_SECOND = int(os.getenv('BYTES_PER_AUDIO_SECOND', 10 * MB))  # Initial guess of peak memory per second of audio
+SMOOTHING = 0.3  # Weight of the newest batch in the moving average
+
+bytes_per_audio_second = BYTES_PER_AUDIO_SECOND
+reservations = {}  # token -> predicted bytes of the running jobs
+reservation_tokens = itertools.count()
+worker_pid = None  # Set by the separation worker
+
+def read_status(field: str, pid='self') -> int:
+    """Read a memory field (VmRSS, VmHWM) of /proc/<pid>/status in bytes, 0 if unavailable."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+def read_rss(pid='self') -> int:
+    return read_status('VmRSS', pid)
+
+def read_peak_rss(pid='self') -> int:
+    return read_status('VmHWM', pid)
+
+def reset_peak_rss():
+    """Reset VmHWM of this process so the next peak is measured per batch."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def predict(duration: float) -> int:
+    return int(duration * bytes_per_audio_second)
+
+def used_memory() -> int:
+    used = read_rss()
+    if worker_pid:
+        used += read_rss(worker_pid)
+    return used
+
+def can_start(duration: float) -> bool:
+    """True if a job of this duration fits the memory budget next to the running jobs."""
+    predicted = used_memory() + sum(reservations.values()) + predict(duration)
+    if predicted > MEMORY_BUDGET:
+        logging.info(f"Holding job back, predicted memory {predicted / MB:.0f} MB is over the {MEMORY_BUDGET / MB:.0f} MB budget.")
+        return False
+    return True
+
+def reserve(duration: float) -> int:
+    token = next(reservation_tokens)
+    reservations[token] = predict(duration)
+    return token
+
+def release(token: int):
+    reservations.pop(token, None)
+
+def record_batch(samples, sample_rate: int, baseline: int, peak: int):
+    """Split the peak RSS growth of a batch per job and update the memory per second of audio."""
+    global bytes_per_audio_second
+    growth = max(peak - baseline, 0)
+    total = sum(samples)
+    if not total:
+        return []
+    observed = growth / (total / sample_rate)
+    bytes_per_audio_second = int((1 - SMOOTHING) * bytes_per_audio_second + SMOOTHING * observed)
+    return [baseline + growth * job_samples // total for job_samples in samples]
+
+def should_recycle(jobs_done: int, rss: int) -> bool:
+    if jobs_done >= RECYCLE_AFTER_JOBS:
+        logging.info(f"Recycling separation worker after {jobs_done} jobs.")
+        return True
+    if rss > RECYCLE_RSS:
+        logging.info(f"Recycling separation worker at {rss / MB:.0f} MB RSS.")
+        return True
+    return False
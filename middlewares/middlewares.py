@@ -7,6 +7,7 @@ import data.connection as dataPostgres
 import re
 import app.keyboardInline as kbIn
 import app.handlers as hanf
+import app.admission as admission
 
 # Format filename for database and file system
 def format_column_namesForDatabase(input_string: str):
@@ -34,10 +35,20 @@ class AudioFileMiddleware(BaseMiddleware):
                     await message.reply(f"The song is too long ({file_duration:.2f} minutes). Please send a song shorter than 6 minutes.")
                     return
 
-                if not await dataPostgres.check_file_exists(file_id):
-                    await dataPostgres.insert_into_input_file(file_id, format_column_namesForDatabase(file_name))
+                # Refuse new uploads early when the queue is already too long
+                wait = hanf.estimate_queue_wait()
+                if not admission.can_admit(wait):
+                    await message.reply(admission.busy_text(wait))
+                    return
+                admission.remember_duration(file_id, message.audio.duration)
+
+                dataPostgres.queue_user_upsert(user_id, message.from_user.username)
+                id_input = await dataPostgres.upsert_input_file(file_id, format_column_namesForDatabase(file_name))
+                if id_input is None:
+                    await message.reply(f"Failed to process {file_name}. Please try again later.")
+                    return
                 try:
-                    await message.reply("Please select the vocal percentage...", reply_markup=await kbIn.percent_choose(file_id))
+                    await message.reply("Please select the vocal percentage...", reply_markup=await kbIn.percent_choose(id_input))
                 except Exception as e:
                     logging.error(f"Error processing audio file: {e}", exc_info=True)
                     await message.reply(f"Failed to process {file_name} due to an error: {str(e)}")
@@ -2,7 +2,9 @@ import os
 import logging
 import time
 import asyncio
-from spleeter.separator import Separator
+import governor
+from separation import batching_separator
+from app.profiles import PROFILES, DEFAULT_PROFILE
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -11,37 +13,37 @@ async def convert_to_wav(input_file, new_folder, base_name):
     """Convert the input file to WAV format asynchronously."""
     wav_input_file = os.path.join(new_folder, f'{base_name}.wav')
     process = await asyncio.create_subprocess_exec(
-        'ffmpeg', '-i', input_file, wav_input_file,
+        *governor.ffmpeg_command(), '-i', input_file, *governor.ffmpeg_args(), wav_input_file,
         stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
     )
     stdout, stderr = await process.communicate()
+    governor.record_ffmpeg_cpu(stderr.decode())
     if process.returncode != 0:
         raise RuntimeError(f"FFmpeg conversion error: {stderr.decode()}")
     return wav_input_file
 
 async def run_spleeter(wav_input_file, new_folder):
-    """Separate the audio using Spleeter (without TensorFlow settings)."""
-    separator = Separator('spleeter:2stems')
+    """Separate the audio using Spleeter, batched together with other queued songs."""
+    await batching_separator.separate_to_file(wav_input_file, new_folder)
 
-    # Run Spleeter in an executor to prevent blocking the event loop
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(None, separator.separate_to_file, wav_input_file, new_folder)
-
-async def convert_accompaniment_to_mp3(accompaniment_file, new_folder, base_name, output_format='mp3'):
-    """Convert the accompaniment (without vocals) to MP3 format asynchronously."""
-    output_file = os.path.join(new_folder, f'{base_name}_minus_320k.{output_format}')
+async def convert_accompaniment_to_mp3(accompaniment_file, new_folder, base_name, profile=DEFAULT_PROFILE):
+    """Convert the accompaniment (without vocals) to the output profile format asynchronously."""
+    settings = PROFILES[profile]
+    output_file = os.path.join(new_folder, f'{base_name}_minus_{settings["suffix"]}.{settings["ext"]}')
     process = await asyncio.create_subprocess_exec(
-        'ffmpeg', '-i', accompaniment_file, '-c:a', 'libmp3lame', '-b:a', '320k', output_file,
+        *governor.ffmpeg_command(), '-i', accompaniment_file, *settings['args'], *governor.ffmpeg_args(), output_file,
         stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
     )
     stdout, stderr = await process.communicate()
+    governor.record_ffmpeg_cpu(stderr.decode())
     if process.returncode != 0:
         raise RuntimeError(f"FFmpeg conversion error: {stderr.decode()}")
     return output_file
 
-async def mix_vocals_and_accompaniment(accompaniment_file, vocals_file, vocal_percentage, new_folder, base_name, output_format='mp3'):
-    """Mix vocals into the accompaniment file based on the vocal percentage and convert to MP3 format."""
-    output_file = os.path.join(new_folder, f'{base_name}_accompaniment_{vocal_percentage}percent_320k.{output_format}')
+async def mix_vocals_and_accompaniment(accompaniment_file, vocals_file, vocal_percentage, new_folder, base_name, profile=DEFAULT_PROFILE):
+    """Mix vocals into the accompaniment file based on the vocal percentage and convert to the output profile format."""
+    settings = PROFILES[profile]
+    output_file = os.path.join(new_folder, f'{base_name}_accompaniment_{vocal_percentage}percent_{settings["suffix"]}.{settings["ext"]}')
 
     vocal_volume = vocal_percentage / 100.0
     accompaniment_volume = 1  # Full volume for accompaniment
@@ -53,21 +55,23 @@ async def mix_vocals_and_accompaniment(accompaniment_file, vocals_file, vocal_pe
     )
 
     process = await asyncio.create_subprocess_exec(
-        'ffmpeg', '-i', accompaniment_file, '-i', vocals_file,
+        *governor.ffmpeg_command(), '-i', accompaniment_file, '-i', vocals_file,
         '-filter_complex', filter_complex,
-        '-c:a', 'libmp3lame', '-q:a', '0',
+        *settings.get('mix_args', settings['args']),
+        *governor.ffmpeg_args(),
         output_file,
         stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
     )
 
     stdout, stderr = await process.communicate()
+    governor.record_ffmpeg_cpu(stderr.decode())
 
     if process.returncode != 0:
         raise RuntimeError(f"FFmpeg mixing error: {stderr.decode()}")
 
     return output_file
 
-async def process_audio_file(input_name: str, vocal_percentage: int, id_input: int, output_format='mp3'):
+async def process_audio_file(input_name: str, vocal_percentage: int, output_directory: str, profile: str = DEFAULT_PROFILE):
     """Process audio file with specified vocal percentage mixed into accompaniment."""
     start_time = time.time()
     logging.info(f"Starting to process audio file: {input_name} with vocal percentage: {vocal_percentage}%")
@@ -91,8 +95,7 @@ async def process_audio_file(input_name: str, vocal_percentage: int, id_input: i
     if input_file is None:
         raise FileNotFoundError(f"No audio file found for base name: {base_name}")
 
-    # Create the output directory
-    output_directory = f'./inputSongs{vocal_percentage}:{id_input}'
+    # Create the output directory, every job has its own
     os.makedirs(output_directory, exist_ok=True)
 
     # Convert to WAV if needed
@@ -118,9 +121,9 @@ async def process_audio_file(input_name: str, vocal_percentage: int, id_input: i
 
     # Process and mix audio
     if vocal_percentage == 0:
-        combined_output_file = await convert_accompaniment_to_mp3(accompaniment_file, output_directory, base_name, output_format)
+        combined_output_file = await convert_accompaniment_to_mp3(accompaniment_file, output_directory, base_name, profile)
     else:
-        combined_output_file = await mix_vocals_and_accompaniment(accompaniment_file, vocals_file, vocal_percentage, output_directory, base_name, output_format)
+        combined_output_file = await mix_vocals_and_accompaniment(accompaniment_file, vocals_file, vocal_percentage, output_directory, base_name, profile)
 
     # Cleanup temporary files
     os.remove(accompaniment_file)
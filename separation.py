@@ -0,0 +1,258 @@
+import os
+import sys
+import socket
+import logging
+import asyncio
+import subprocess
+from multiprocessing.connection import Connection
+from collections import Counter
+import governor
+import memory_watchdog
+
+# Batching separator service.
+# Songs from several queued jobs are joined into one long waveform and
+# separated in a single model pass: Spleeter cuts the spectrogram into fixed
+# size segments and runs them as one batch, so short songs arriving together
+# share the per-call overhead. The stems are then cut back out per job.
+#
+# The model runs in a separate worker process (separation_worker), which is
+# recycled after RECYCLE_AFTER_JOBS songs or above RECYCLE_RSS. If a batch
+# fails or the worker is killed, its jobs are retried one by one.
+
+BATCH_SIZE = int(os.getenv('SEPARATION_BATCH_SIZE', 4))  # Max jobs per model pass
+BATCH_MAX_SECONDS = int(os.getenv('SEPARATION_BATCH_MAX_SECONDS', 1200))  # Max audio per model pass
+BATCH_WAIT = float(os.getenv('SEPARATION_BATCH_WAIT', 2.0))  # Seconds to wait for more jobs
+SEPARATION_TIMEOUT = float(os.getenv('SEPARATION_TIMEOUT', 300))  # Seconds a batch may take, plus the per audio second part
+SEPARATION_TIMEOUT_PER_SECOND = float(os.getenv('SEPARATION_TIMEOUT_PER_SECOND', 2.0))  # Seconds per second of audio
+SAMPLE_RATE = 44100
+WAV_BYTES_PER_SECOND = SAMPLE_RATE * 2 * 2  # 16-bit stereo WAV
+MB = memory_watchdog.MB
+
+class WorkerDied(RuntimeError):
+    pass
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'separation_worker.py')
+
+class SeparationWorker:
+    def __init__(self):
+        self.process = None
+        self.conn = None
+        self.jobs_done = 0
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        # A fresh interpreter rather than a fork of the bot: forking a process
+        # with running threads can deadlock, and the child would inherit its
+        # aiohttp and Postgres sockets. Only the pipe to the worker is passed on.
+        parent_sock, child_sock = socket.socketpair()
+        with child_sock:
+            self.process = subprocess.Popen(
+                [sys.executable, WORKER_SCRIPT, str(child_sock.fileno())],
+                pass_fds=(child_sock.fileno(),)
+            )
+        self.conn = Connection(parent_sock.detach())
+        self.jobs_done = 0
+        memory_watchdog.worker_pid = self.process.pid
+        logging.info(f"Started separation worker {self.process.pid}")
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.conn.close()
+        logging.info(f"Stopped separation worker {self.process.pid}")
+        self.process = None
+        memory_watchdog.worker_pid = None
+
+    def _reap(self):
+        """Clean up after a dead or killed worker and return its exit code."""
+        try:
+            exitcode = self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            exitcode = self.process.wait()
+        self.conn.close()
+        self.process = None
+        memory_watchdog.worker_pid = None
+        return exitcode
+
+    def run(self, jobs):
+        """
+        Separate a batch in the worker process. Blocking, call it from an executor.
+
+        :param jobs: List of (wav_input_file, destination) pairs.
+        :return: List of (cpu_seconds, peak_rss) per job.
+        """
+        if not self.is_alive():
+            self.stop()
+            self.start()
+        # A hung worker would hold the model forever, so it gets a deadline from the audio length
+        seconds = sum(os.path.getsize(wav_input_file) for wav_input_file, _ in jobs) / WAV_BYTES_PER_SECOND
+        timeout = SEPARATION_TIMEOUT + SEPARATION_TIMEOUT_PER_SECOND * seconds
+        try:
+            self.conn.send(jobs)
+            if not self.conn.poll(timeout):
+                self.process.kill()
+                self._reap()
+                raise WorkerDied(f"Separation worker did not answer within {timeout:.0f} s and was killed")
+            result = self.conn.recv()
+        except (EOFError, OSError):
+            exitcode = self._reap()
+            raise WorkerDied(f"Separation worker died with exit code {exitcode}")
+
+        if result[0] == 'error':
+            raise RuntimeError(result[1])
+        _, results, baseline, peak = result
+        self.jobs_done += len(jobs)
+        peaks = memory_watchdog.record_batch([samples for _, samples in results], SAMPLE_RATE, baseline, peak)
+        if memory_watchdog.should_recycle(self.jobs_done, memory_watchdog.read_rss(self.process.pid)):
+            self.stop()
+        return [(cpu, job_peak) for (cpu, _), job_peak in zip(results, peaks)]
+
+class BatchingSeparator:
+    def __init__(self, max_batch: int = BATCH_SIZE, max_seconds: int = BATCH_MAX_SECONDS, max_wait: float = BATCH_WAIT):
+        self.max_batch = max_batch
+        self.max_bytes = max_seconds * WAV_BYTES_PER_SECOND
+        self.max_wait = max_wait
+        self.worker = SeparationWorker()
+        self.pending = []  # ((wav_input_file, destination), future, size)
+        self.pending_bytes = 0
+        self.flush_handle = None
+        self.busy = False  # A batch is running, new songs wait for the model to free up
+        self.batch_tasks = set()
+        self.model_lock = asyncio.Lock()  # One model pass at a time
+        self.in_worker = Counter()  # destination -> songs of flushed batches not finished yet
+        self.batch_finished = asyncio.Condition()
+
+    async def _run(self, jobs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.worker.run, jobs)
+
+    def _flush(self):
+        """Run the oldest pending songs, up to max_batch and max_bytes, in a task if the model is free."""
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.busy or not self.pending:
+            return
+        batch = []
+        batch_bytes = 0
+        while self.pending and len(batch) < self.max_batch:
+            job, future, size = self.pending[0]
+            if batch and batch_bytes + size > self.max_bytes:
+                break
+            self.pending.pop(0)
+            batch.append((job, future))
+            batch_bytes += size
+        self.pending_bytes -= batch_bytes
+        self.busy = True
+        self.in_worker.update(destination for (_, destination), _ in batch)
+        task = asyncio.ensure_future(self._run_batch(batch))
+        self.batch_tasks.add(task)
+        task.add_done_callback(self.batch_tasks.discard)
+
+    async def _run_batch(self, batch):
+        try:
+            await self._separate_batch(batch)
+        finally:
+            self.in_worker.subtract(destination for (_, destination), _ in batch)
+            self.in_worker += Counter()  # Drop destinations that reached zero
+            self.busy = False
+            # Songs that arrived during the pass have waited already, run them right away
+            self._flush()
+            async with self.batch_finished:
+                self.batch_finished.notify_all()
+
+    async def _separate_batch(self, batch):
+        async with self.model_lock:
+            logging.info(f"Running separation batch of {len(batch)} songs")
+            try:
+                results = await self._run([job for job, _ in batch])
+            except WorkerDied as e:
+                logging.error(f"{e}, retrying {len(batch)} songs one by one on a fresh worker")
+                await self._retry_one_by_one(batch)
+                return
+            except Exception as e:
+                if len(batch) > 1:
+                    # One bad song must not fail the others of its batch
+                    logging.error(f"{e}, retrying {len(batch)} songs one by one")
+                    await self._retry_one_by_one(batch)
+                    return
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _retry_one_by_one(self, batch):
+        # Called with model_lock held. A song that fails or kills the worker alone fails only itself.
+        for job, future in batch:
+            try:
+                result = (await self._run([job]))[0]
+            except Exception as e:
+                logging.error(f"Separation of {job[0]} failed on its own: {e}")
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            if not future.done():
+                future.set_result(result)
+
+    async def separate(self, wav_input_file: str, destination: str):
+        """Queue a song for the next batch and wait for its share of CPU time and peak RSS."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        size = os.path.getsize(wav_input_file)
+        self.pending.append(((wav_input_file, destination), future, size))
+        self.pending_bytes += size
+
+        # While a batch runs, songs gather for the next one and go when the model frees up.
+        # max_wait only holds songs back for company while the model is idle.
+        if not self.busy:
+            if len(self.pending) >= self.max_batch or self.pending_bytes >= self.max_bytes:
+                self._flush()
+            elif self.flush_handle is None:
+                self.flush_handle = loop.call_later(self.max_wait, self._flush)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # Not flushed yet: take the song out, so the batch does not read files about to be deleted
+            entry = next((entry for entry in self.pending if entry[1] is future), None)
+            if entry:
+                self.pending.remove(entry)
+                self.pending_bytes -= size
+                if not self.pending and self.flush_handle:
+                    self.flush_handle.cancel()
+                    self.flush_handle = None
+            raise
+
+    async def wait_for_destination(self, destination: str):
+        """Wait until no batch already sent to the worker still uses destination."""
+        async with self.batch_finished:
+            await self.batch_finished.wait_for(lambda: destination not in self.in_worker)
+
+    async def separate_to_file(self, wav_input_file: str, destination: str):
+        """Same output layout as Separator.separate_to_file: destination/<name>/<instrument>.wav"""
+        cpu, peak_rss = await self.separate(wav_input_file, destination)
+        governor.add_cpu_time('separation', cpu)
+        logging.info(f"Separation of {wav_input_file}: peak worker RSS {peak_rss / MB:.0f} MB")
+
+    def start(self):
+        """Start the worker at startup, so the first song does not wait for the model to load."""
+        self.worker.start()
+
+    def close(self):
+        self.worker.stop()
+
+batching_separator = BatchingSeparator()
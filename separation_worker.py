@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+import logging
+import numpy as np
+import governor
+import memory_watchdog
+
+governor.configure_tensorflow()  # Thread pools are read when TensorFlow is imported
+
+from spleeter.separator import Separator
+from spleeter.audio.adapter import AudioAdapter
+from multiprocessing.connection import Connection
+
+# Runs as the separation worker process, started by separation.SeparationWorker
+# with the file descriptor of its end of the pipe as the only argument.
+# Only this process loads TensorFlow, so the bot survives if it gets killed.
+
+SAMPLE_RATE = 44100
+GAP_SAMPLES = 4096  # Silence between songs so no STFT frame spans two songs
+CHANNELS = 2  # The 2stems model works on stereo
+
+def to_stereo(waveform):
+    """Mono is duplicated and extra channels dropped, so all songs of a batch can be joined."""
+    if waveform.shape[1] == 1:
+        return np.repeat(waveform, CHANNELS, axis=1)
+    return waveform[:, :CHANNELS]
+
+def separate_batch(separator, audio_adapter, jobs):
+    """
+    Separate all songs of a batch in one model pass and write their stems.
+
+    :param jobs: List of (wav_input_file, destination) pairs.
+    :return: List of (cpu_seconds, samples) per job.
+    """
+    cpu_started_at = time.process_time()
+    waveforms = [to_stereo(audio_adapter.load(wav_input_file, sample_rate=SAMPLE_RATE)[0]) for wav_input_file, _ in jobs]
+
+    gap = np.zeros((GAP_SAMPLES, CHANNELS), dtype=np.float32)
+    parts = []
+    offsets = []
+    position = 0
+    for waveform in waveforms:
+        parts.extend([waveform, gap])
+        offsets.append((position, position + len(waveform)))
+        position += len(waveform) + GAP_SAMPLES
+    prediction = separator.separate(np.concatenate(parts))
+
+    # Same output layout as Separator.separate_to_file: destination/<name>/<instrument>.wav
+    for (wav_input_file, destination), (start, end) in zip(jobs, offsets):
+        base_name = os.path.splitext(os.path.basename(wav_input_file))[0]
+        stem_folder = os.path.join(destination, base_name)
+        os.makedirs(stem_folder, exist_ok=True)
+        for instrument, data in prediction.items():
+            audio_adapter.save(os.path.join(stem_folder, f'{instrument}.wav'), data[start:end], SAMPLE_RATE, 'wav')
+
+    cpu = time.process_time() - cpu_started_at
+    return [(cpu * (end - start) / position, end - start) for start, end in offsets]
+
+def worker_main(conn):
+    """Serve batches from the bot process until it sends None or closes the pipe."""
+    separator = Separator('spleeter:2stems')
+    audio_adapter = AudioAdapter.default()
+    while True:
+        try:
+            jobs = conn.recv()
+        except EOFError:
+            break
+        if jobs is None:
+            break
+
+        baseline = memory_watchdog.read_rss()
+        memory_watchdog.reset_peak_rss()
+        try:
+            results = separate_batch(separator, audio_adapter, jobs)
+            conn.send(('ok', results, baseline, memory_watchdog.read_peak_rss()))
+        except Exception as e:
+            conn.send(('error', f"Separation error: {e}"))
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    worker_main(Connection(int(sys.argv[1])))